@@ -9,7 +9,7 @@ from time import perf_counter
 import multiprocessing as mp
 import os
 
-from functions import get_file_names_regex, load_transactions_from_csv, classify_transaction
+from functions import get_file_names_regex, load_transactions_from_csv, write_transactions_to_csv, classify_transaction, get_chunksize
 
 
 def classify_transactions(data_io_directory, file_regex_pattern):
@@ -44,16 +44,14 @@ def classify_transactions(data_io_directory, file_regex_pattern):
         print('done')
 
         print(f'{indent}    classifying transactions... ', end='', flush=True)
-        classified_transactions = pool.map(classify_transaction, transactions)
+        chunksize = get_chunksize(len(transactions), num_processes)
+        classified_transactions = pool.map(
+            classify_transaction, transactions, chunksize=chunksize)
         print('done')
 
         print(f'{indent}    writing new csv file... ', end='', flush=True)
-        with open(f'{output_directory}/{file_name}', 'w') as output_file:
-            output_file.write(
-                'transaction_hash,num_inputs,input_addresses,input_values,num_outputs,output_addresses,output_values,transaction_fee,transaction_class\n')
-
-            for transaction in classified_transactions:
-                output_file.write(transaction.to_csv_string())
+        write_transactions_to_csv(
+            f'{output_directory}/{file_name}', classified_transactions)
         print('done')
 
         file_end = perf_counter()
@@ -9,11 +9,50 @@ from time import perf_counter
 from datetime import datetime
 from dateutil import tz
 from dateutil.relativedelta import *
-from urllib.request import urlopen
-import json
+import orjson
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from logging.handlers import QueueHandler, QueueListener
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
+import multiprocessing as mp
 import os
-import re
+import requests
+import shutil
+
+# blocks are downloaded concurrently, since collection time is dominated by
+# waiting on the blockchain.com api rather than by local processing
+MAX_WORKERS = 16
+
+# days are written to separate sub-directories, so several days are collected
+# at once in separate processes
+MAX_DAY_WORKERS = 4
+
+TIMEOUT = (5, 30)
+
+
+def create_session():
+    """
+    returns:    a session used for all requests to the blockchain.com api, so that
+                connections are reused instead of opening a new connection for every block
+
+                requests that are rate limited or hit a server error are retried with
+                exponential backoff
+    """
+    session = requests.Session()
+    session.mount(
+        'https://',
+        HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=32,
+            max_retries=Retry(
+                total=5,
+                backoff_factor=0.3,
+                status_forcelist=[429, 500, 502, 503, 504])))
+    return session
+
+
+SESSION = create_session()
 
 
 def get_days(start_day, end_day):
@@ -42,100 +81,127 @@ def get_block_summaries(day):
     timestamp = int(day.timestamp() * 1000)
 
     url = f'https://blockchain.info/blocks/{str(timestamp)}?format=json'
-    response = urlopen(url)
+    response = SESSION.get(url, timeout=TIMEOUT)
+    response.raise_for_status()
 
-    block_summaries = json.load(response)
+    block_summaries = orjson.loads(response.content)
     return block_summaries
 
 
-def get_block(block_hash):
+def download_block(block_hash, target_path):
     """
-    inputs:     a block hash
+    inputs:     a block hash and the path the block should be saved to
 
-    returns:    a dictionary containg all information related to the specifed block
+    outputs:    a json file containg all information related to the specifed block
                 including header information and a list of transactions contained within the block
     """
 
     url = f'https://blockchain.info/rawblock/{block_hash}'
-    response = urlopen(url)
 
-    block_data = json.load(response)
-    return block_data
+    # the block is only saved to disk, so the response is streamed straight to
+    # the file instead of being parsed and serialized again
+    # it is written to a temporary file first, so that an interrupted download
+    # is never mistaken for a collected block, and the temporary file is removed
+    # if the download fails
+    temp_path = f'{target_path}.part'
+    try:
+        with SESSION.get(url, timeout=TIMEOUT, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
 
+            with open(temp_path, 'wb') as output_file:
+                shutil.copyfileobj(response.raw, output_file, length=1 << 20)
 
-def load_json(filepath):
-    with open(filepath, 'r') as fp:
-        data = json.load(fp)
-    return data
+        os.replace(temp_path, target_path)
 
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def fetch_and_save(block_hash, day_directory):
+    """
+    inputs:     a block hash and the directory the block should be saved to
+
+    returns:    the block hash, whether or not the block was collected successfully,
+                and the time it took to collect the block
+    """
+    block_start = perf_counter()
+
+    try:
+        download_block(block_hash, f'{day_directory}/{block_hash}.json')
+        ok = True
+
+    except BaseException:
+        ok = False
+
+    block_time = perf_counter() - block_start
+    return block_hash, ok, block_time
 
-def save_json(filepath, data):
-    with open(filepath, 'w') as output_file:
-        json.dump(data, output_file)
 
+def load_json(filepath):
+    with open(filepath, 'rb') as fp:
+        data = orjson.loads(fp.read())
+    return data
 
-# configure logging
-if not os.path.exists('logs'):
-    os.mkdir('logs')
 
-logging.basicConfig(
-    filename='logs/collect_blocks.log',
-    filemode='w',
-    format='%(asctime)s - %(levelname)s: %(message)s',
-    level=logging.DEBUG)
+def save_json(filepath, data):
+    with open(filepath, 'wb') as output_file:
+        output_file.write(orjson.dumps(data))
 
-program_start = perf_counter()
 
-# set start and end days, and create datetime objects for all days in range
-# time_period_days = 90
-# end_day = datetime(year=2021, month=6, day=28, tzinfo = tz.gettz('Etc/GMT'))
-# start_day = end_day - relativedelta(days=time_period_days)
+def init_day_worker(log_queue):
+    """
+    inputs:     the queue used to send log records back to the main process
 
-start_day = datetime(year=2021, month=5, day=30, tzinfo=tz.gettz('Etc/GMT'))
-end_day = datetime(year=2021, month=6, day=30, tzinfo=tz.gettz('Etc/GMT'))
+    each worker process gets its own session, and logs through the main process
+    so that log lines from different days are written to a single file
+    """
+    global SESSION
+    SESSION = create_session()
 
-days = get_days(start_day, end_day)
+    root_logger = logging.getLogger()
+    root_logger.handlers = [QueueHandler(log_queue)]
+    root_logger.setLevel(logging.DEBUG)
 
-# create a directory to store the block json files
-try:
-    if not os.path.exists('../block_data'):
-        os.mkdir('../block_data')
-except BaseException:
-    message = 'could not create block_data directory'
-    logging.critical(message)
-    raise
 
-# used to keep track of errors that occur
-failed_days = set()
-failed_blocks = {}
+def process_day(day):
+    """
+    inputs:     a datetime object
 
-for day in days:
+    returns:    the day as a string, whether or not the block summaries for the day
+                could be retrieved, and the set of hashes of blocks that could not be retrieved
+    """
     day_start = perf_counter()
 
     day_string = day.strftime("%Y-%m-%d")
     day_directory = f'../block_data/{day_string}'
 
+    failed_hashes = set()
+
     logging.info(f'collecting blocks from {day_string}\n')
 
     summary_file_exists = False
 
+    # files that have already been collected for the current day
+    # the directory is only listed once per day
+    existing_files = set()
+
     # create a sub-directory for each day to help keep things organized
     if os.path.exists(day_directory):
         logging.debug(f'found pre-existing sub-directory for {day_string}')
 
+        existing_files = set(os.listdir(day_directory))
+
         # check to see if block summaries have already been collected for this
         # day
-        sfile_name_pattern = re.compile("^blocks*")
-        for file in os.listdir(day_directory):
-            if sfile_name_pattern.match(file):
-                summary_file_exists = True
+        summary_file_exists = f'blocks_{day_string}.json' in existing_files
 
     else:
         try:
             os.mkdir(day_directory)
         except BaseException:
-            failed_days.add(day_string)
-
             message = f'could not create directory for day {day_string}'
             logging.critical(message)
             raise
@@ -161,82 +227,125 @@ for day in days:
             save_json(file_name, block_summaries)
 
         except BaseException:
-            failed_days.add(day_string)
             logging.error(f'failed to load block summaries for {day_string}')
 
-            continue
+            return day_string, False, failed_hashes
 
     # colllect all blocks added on the current day
     # either from the blockchain.com data api, or a local file, if one exists
-    current_block_num = 1
-    for block in block_summaries:
-        block_start = perf_counter()
-
-        block_hash = block.get('hash')
-
-        # check to see if the block already exists locally
-        block_exists = False
-        for file in os.listdir(day_directory):
-            if file == f'{block_hash}.json':
-                block_exists = True
-                logging.info(
-                    f'block {block_hash} ({current_block_num}/{num_blocks}) already collected')
-                current_block_num += 1
-                break
+    missing_hashes = [
+        block['hash'] for block in block_summaries
+        if f'{block["hash"]}.json' not in existing_files]
 
-        if block_exists:
-            continue
-
-        try:
-            block_data = get_block(block_hash)
+    current_block_num = num_blocks - len(missing_hashes)
+    logging.info(
+        f'{current_block_num}/{num_blocks} blocks from {day_string} already collected')
 
-        except BaseException:
-            if day_string in failed_blocks:
-                failed_blocks[day_string].add(block_hash)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [
+            executor.submit(fetch_and_save, block_hash, day_directory)
+            for block_hash in missing_hashes]
 
-            else:
-                failed_blocks[day_string] = {block_hash}
+        # progress is logged from the main thread as blocks finish downloading
+        for future in as_completed(futures):
+            block_hash, ok, block_time = future.result()
 
-            logging.error(f'failed to load block {block_hash}')
-            continue
+            if not ok:
+                failed_hashes.add(block_hash)
 
-        filename = f'../block_data/{day_string}/{block_hash}.json'
-        save_json(filename, block_data)
+                logging.error(f'failed to load block {block_hash}')
+                continue
 
-        block_end = perf_counter()
-        block_time = block_end - block_start
-        logging.info(
-            f'collected block {block_hash} ({current_block_num}/{num_blocks}) - block processing time: {block_time:.2f}s')
-        current_block_num += 1
+            current_block_num += 1
+            logging.info(
+                f'collected block {block_hash} ({current_block_num}/{num_blocks}) - block processing time: {block_time:.2f}s')
 
     day_end = perf_counter()
     day_time = (day_end - day_start) / 60
     logging.info(
         f'collected {num_blocks} blocks from {day_string} - day processing time: {day_time:.2f} minutes\n')
 
-# report errors that occured
+    return day_string, True, failed_hashes
+
+
+if __name__ == '__main__':
+    # configure logging
+    if not os.path.exists('logs'):
+        os.mkdir('logs')
+
+    logging.basicConfig(
+        filename='logs/collect_blocks.log',
+        filemode='w',
+        format='%(asctime)s - %(levelname)s: %(message)s',
+        level=logging.DEBUG)
+
+    # log records from the worker processes are written by the main process
+    log_queue = mp.Queue()
+    log_listener = QueueListener(log_queue, *logging.getLogger().handlers)
+    log_listener.start()
+
+    program_start = perf_counter()
+
+    # set start and end days, and create datetime objects for all days in range
+    # time_period_days = 90
+    # end_day = datetime(year=2021, month=6, day=28, tzinfo = tz.gettz('Etc/GMT'))
+    # start_day = end_day - relativedelta(days=time_period_days)
+
+    start_day = datetime(year=2021, month=5, day=30, tzinfo=tz.gettz('Etc/GMT'))
+    end_day = datetime(year=2021, month=6, day=30, tzinfo=tz.gettz('Etc/GMT'))
+
+    days = get_days(start_day, end_day)
+
+    # create a directory to store the block json files
+    try:
+        if not os.path.exists('../block_data'):
+            os.mkdir('../block_data')
+    except BaseException:
+        message = 'could not create block_data directory'
+        logging.critical(message)
+        raise
+
+    # used to keep track of errors that occur
+    failed_days = set()
+    failed_blocks = {}
+
+    with ProcessPoolExecutor(
+            max_workers=MAX_DAY_WORKERS,
+            initializer=init_day_worker,
+            initargs=(log_queue,)) as executor:
+
+        for (day_string, day_ok, failed_hashes) in executor.map(process_day, days):
+            if not day_ok:
+                failed_days.add(day_string)
+
+            if failed_hashes:
+                failed_blocks[day_string] = failed_hashes
+
+    log_listener.stop()
+
+    # report errors that occured
 
-num_failed_days = len(failed_days)
-failed_days_message = f'all blocks added on the following {num_failed_days} days could not be retrieved:\n\n'
+    num_failed_days = len(failed_days)
+    failed_days_message = f'all blocks added on the following {num_failed_days} days could not be retrieved:\n\n'
 
-for day in failed_days:
-    failed_days_message += f'    {day}\n'
-failed_days_message += '\n'
+    for day in failed_days:
+        failed_days_message += f'    {day}\n'
+    failed_days_message += '\n'
 
-logging.error(failed_days_message)
+    logging.error(failed_days_message)
 
-num_failed_blocks = len(failed_blocks)
-failed_blocks_message = f'the following {num_failed_blocks} individual blocks could not be retrieved:\n\n'
+    num_failed_blocks = len(failed_blocks)
+    failed_blocks_message = f'the following {num_failed_blocks} individual blocks could not be retrieved:\n\n'
 
-for day in failed_blocks:
-    failed_blocks_message += f'    {day}\n'
+    for day in failed_blocks:
+        failed_blocks_message += f'    {day}\n'
 
-    for hash in failed_blocks.get(day):
-        failed_blocks_message += f'        {hash}\n'
-failed_blocks_message += '\n'
+        for hash in failed_blocks.get(day):
+            failed_blocks_message += f'        {hash}\n'
+    failed_blocks_message += '\n'
 
-logging.error(failed_blocks_message)
+    logging.error(failed_blocks_message)
 
-program_end = perf_counter()
-execution_time = (program_end - program_start) / 60 / 60
-logging.info(f'execution finished in {execution_time:.2f} hours\n')
+    program_end = perf_counter()
+    execution_time = (program_end - program_start) / 60 / 60
+    logging.info(f'execution finished in {execution_time:.2f} hours\n')
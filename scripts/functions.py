@@ -1,4 +1,5 @@
-from itertools import permutations
+from functools import lru_cache
+from operator import itemgetter
 import os
 import re
 import csv
@@ -43,6 +44,17 @@ def load_transactions_from_csv(csv_file_path):
     return transactions
 
 
+def write_transactions_to_csv(csv_file_path, transactions):
+    # the whole file is built in memory and written with a single call, rather
+    # than issuing a separate write for every transaction
+    lines = [transaction.to_csv_string() for transaction in transactions]
+
+    with open(csv_file_path, 'w') as output_file:
+        output_file.write(
+            'transaction_hash,num_inputs,input_addresses,input_values,num_outputs,output_addresses,output_values,transaction_fee,transaction_class\n')
+        output_file.write(''.join(lines))
+
+
 def write_csv(file_name, data):
     with open(file_name, 'w') as output_file:
         writer = csv.writer(output_file)
@@ -95,21 +107,28 @@ def tx_partition_to_string(tx_partition):
 def get_codewords(n, k):
     codewords = []
     codeword = [1 for _ in range(0, n)]
+
+    # prefix_max[i] holds max(codeword[0: i + 1]), so the maximum of a prefix
+    # does not need to be recomputed every time a codeword is advanced
+    prefix_max = [1 for _ in range(0, n)]
     while True:
-        codewords.append(codeword.copy())
+        codewords.append(tuple(codeword))
+
         startIndex = n - 1
-        while startIndex >= 0:
-            if not codeword[0: startIndex]:
-                return codewords
-            else:
-                maxValue = max(codeword[0: startIndex])
-                codewordAtStartIndex = codeword[startIndex]
-                if maxValue > k or codewordAtStartIndex > maxValue or codewordAtStartIndex >= k:
-                    codeword[startIndex] = 1
-                    startIndex -= 1
-                else:
-                    codeword[startIndex] += 1
-                    break
+        while startIndex > 0 and (
+                codeword[startIndex] > prefix_max[startIndex - 1]
+                or codeword[startIndex] >= k):
+            codeword[startIndex] = 1
+            startIndex -= 1
+
+        if startIndex <= 0:
+            return tuple(codewords)
+
+        codeword[startIndex] += 1
+
+        maxValue = max(prefix_max[startIndex - 1], codeword[startIndex])
+        for i in range(startIndex, n):
+            prefix_max[i] = maxValue
 
 
 def get_partitions(list, max_size):
@@ -148,44 +167,162 @@ def group_partitions_by_size(partitions):
             partition_dict[size] = [partition]
     return partition_dict
 
-# connectability criteria from "Shared Send Untangling in Bitcoin"
+
+@lru_cache(maxsize=None)
+def get_index_partitions(n, max_size):
+    '''
+    input:      a number of elements, and the maximum number of subsets
+
+    returns:    all partitions of the indices 0 to n - 1 into at most max_size subsets,
+    grouped by size as in group_partitions_by_size
+
+    the result only depends on the shape of a transaction, so it is cached and
+    shared between transactions; it is made of tuples so it cannot be modified
+    '''
+    partitions = get_partitions(list(range(n)), max_size)
+    partitions = [tuple(tuple(subset) for subset in partition)
+                  for partition in partitions]
+    return group_partitions_by_size(partitions)
 
 
-def is_connectable(input_subset, output_subset, transaction_fee):
-    input_sum = sum([item[1] for item in input_subset])
-    output_sum = sum([item[1] for item in output_subset])
+@lru_cache(maxsize=None)
+def get_partition_masks(n, max_size):
+    '''
+    input:      a number of elements, and the maximum number of subsets
+
+    returns:    the partitions from get_index_partitions, with each subset
+    represented as a bitmask where bit i is set if index i is in the subset
+    '''
+    partition_masks = {}
+    for (size, partitions) in get_index_partitions(n, max_size).items():
+        partition_masks[size] = tuple(
+            tuple(sum(1 << i for i in subset) for subset in partition)
+            for partition in partitions)
+    return partition_masks
+
+
+def get_subset_sum_table(values):
+    '''
+    input:      the values of a list of inputs or outputs
 
+    returns:    a list where the entry at each bitmask is the total value of the
+                subset represented by that bitmask
+    '''
+    # each subset sum is built from the sum of the same subset without its
+    # lowest element, so every entry takes a single addition
+    subset_sums = [0] * (1 << len(values))
+    for mask in range(1, len(subset_sums)):
+        lowest_bit = mask & -mask
+        subset_sums[mask] = subset_sums[mask ^ lowest_bit] + \
+            values[lowest_bit.bit_length() - 1]
+    return subset_sums
+
+
+def gather_partition(items, partition):
+    '''
+    input:      a list of inputs or outputs, and a partition of their indices
+
+    returns:    the partition with each index replaced by the corresponding item
+    '''
+    return [[items[i] for i in subset] for subset in partition]
+
+# connectability criteria from "Shared Send Untangling in Bitcoin"
+
+
+def is_connectable(input_sum, output_sum, transaction_fee):
     a = output_sum + transaction_fee
     return(a >= input_sum and input_sum >= output_sum)
 
 
+def is_matchable(sorted_input_sums, sorted_output_sums, transaction_fee):
+    '''
+    input:      the sorted subset sums of an input partition and an output partition
+                of the same size, and the transaction fee
+
+    returns:    whether the subsets of the two partitions can be connected in any order
+    '''
+    # every output subset can be connected to input subsets whose sums fall in
+    # a range of the same width, so if the subsets can be connected in any order
+    # they can be connected by pairing them in order of value
+    for (input_sum, output_sum) in zip(sorted_input_sums, sorted_output_sums):
+        if not is_connectable(input_sum, output_sum, transaction_fee):
+            return False
+    return True
+
+
 def get_acceptable_connections(
         partition_size,
         input_partition,
         output_partition,
-        transaction_fee):
+        transaction_fee,
+        input_sums,
+        output_sums):
 
     acceptable_connections = []
 
-    # check the input partition against all possible orderings of the output
-    # partition
-    output_orders = list(permutations(output_partition, len(output_partition)))
-    for output_ordering in output_orders:
-        acceptable = True
+    # check every pair of input and output subsets once, recording which
+    # output subsets each input subset can be connected to
+    connectable_outputs = []
+    for input_sum in input_sums:
+        outputs = [j for j in range(partition_size)
+                   if is_connectable(input_sum, output_sums[j], transaction_fee)]
+
+        # an input subset that cannot be connected to any output subset rules
+        # out every ordering of the output partition
+        if not outputs:
+            return acceptable_connections
+
+        connectable_outputs.append(outputs)
+
+    # search the orderings of the output partition that only pair connectable
+    # subsets, abandoning an ordering as soon as it cannot be completed
+    output_orders = []
+    find_output_orders(
+        0,
+        [False] * partition_size,
+        [],
+        connectable_outputs,
+        output_orders)
+
+    for output_order in output_orders:
+        output_ordering = tuple(output_partition[j] for j in output_order)
+        partition = (input_partition, output_ordering)
+        acceptable_connections.append(partition)
 
-        for i in range(partition_size):
-            pair_connectable = is_connectable(
-                input_partition[i], output_ordering[i], transaction_fee)
+    return acceptable_connections
 
-            if not pair_connectable:
-                acceptable = False
-                break
 
-        if acceptable:
-            partition = (input_partition, output_ordering)
-            acceptable_connections.append(partition)
+def find_output_orders(
+        i,
+        used_outputs,
+        output_order,
+        connectable_outputs,
+        output_orders):
+    '''
+    input:      the index of the input subset to connect next, flags marking the
+                output subsets that have already been connected, the output
+                indices connected to the previous input subsets, and the output
+                subsets each input subset can be connected to
 
-    return acceptable_connections
+    output:     every complete ordering of output indices whose pairs are all
+                connectable is appended to output_orders
+    '''
+    if i == len(connectable_outputs):
+        output_orders.append(output_order.copy())
+        return
+
+    for j in connectable_outputs[i]:
+        if not used_outputs[j]:
+            used_outputs[j] = True
+            output_order.append(j)
+            find_output_orders(
+                i + 1,
+                used_outputs,
+                output_order,
+                connectable_outputs,
+                output_orders)
+            output_order.pop()
+            used_outputs[j] = False
 
 
 def get_acceptable_partitions(transaction):
@@ -194,18 +331,62 @@ def get_acceptable_partitions(transaction):
 
     max_partition_size = min(num_inputs, num_outputs)
 
-    input_partitions = get_partitions(transaction.inputs, max_partition_size)
-    output_partitions = get_partitions(transaction.outputs, max_partition_size)
+    # partitions are built over the indices of the inputs and outputs, with
+    # their values kept in separate lists, so that inputs and outputs only need
+    # to be gathered into subsets for partitions that are acceptable
+    input_values = [input[1] for input in transaction.inputs]
+    output_values = [output[1] for output in transaction.outputs]
+
+    input_partitions = get_index_partitions(num_inputs, max_partition_size)
+    output_partitions = get_index_partitions(num_outputs, max_partition_size)
 
-    input_partitions = group_partitions_by_size(input_partitions)
-    output_partitions = group_partitions_by_size(output_partitions)
+    # subset sums are looked up by bitmask in a table built once per transaction,
+    # and computed once per partition rather than once for every pair of
+    # partitions they are compared in
+    input_sum_table = get_subset_sum_table(input_values)
+    output_sum_table = get_subset_sum_table(output_values)
+
+    input_masks = get_partition_masks(num_inputs, max_partition_size)
+    output_masks = get_partition_masks(num_outputs, max_partition_size)
+
+    input_sums = {size: [[input_sum_table[mask] for mask in masks] for masks in partitions]
+                  for (size, partitions) in input_masks.items()}
+    output_sums = {size: [[output_sum_table[mask] for mask in masks] for masks in partitions]
+                   for (size, partitions) in output_masks.items()}
 
     acceptable_partitions = []
     for i in range(2, max_partition_size + 1):
-        for input_partition in input_partitions[i]:
-            for output_partition in output_partitions[i]:
-                acceptable_partitions += get_acceptable_connections(
-                    i, input_partition, output_partition, transaction.fee)
+        # output partitions with the same subset sums can be connected to
+        # exactly the same input partitions, so they are grouped by their sorted
+        # subset sums and each group is checked against an input partition once
+        output_groups = {}
+        for (output_partition, out_sums) in zip(
+                output_partitions[i], output_sums[i]):
+            signature = tuple(sorted(out_sums))
+            if signature in output_groups:
+                output_groups[signature].append((output_partition, out_sums))
+            else:
+                output_groups[signature] = [(output_partition, out_sums)]
+
+        for (input_partition, in_sums) in zip(
+                input_partitions[i], input_sums[i]):
+            sorted_in_sums = sorted(in_sums)
+
+            for (sorted_out_sums, output_group) in output_groups.items():
+                if not is_matchable(
+                        sorted_in_sums, sorted_out_sums, transaction.fee):
+                    continue
+
+                for (output_partition, out_sums) in output_group:
+                    connections = get_acceptable_connections(
+                        i, input_partition, output_partition, transaction.fee,
+                        in_sums, out_sums)
+
+                    for (input_indices, output_indices) in connections:
+                        partition = (
+                            gather_partition(transaction.inputs, input_indices),
+                            tuple(gather_partition(transaction.outputs, output_indices)))
+                        acceptable_partitions.append(partition)
 
     return acceptable_partitions
 
@@ -250,118 +431,131 @@ def func(transaction):
 def consolodate_same_addresses(transaction):
     # consolodate input addresses
     input_dict = {}
-    for input in transaction.inputs:
-        if input[0] in input_dict:
-            input_dict[input[0]] += input[1]
-        else:
-            input_dict[input[0]] = input[1]
-    transaction.inputs = list(input_dict.items())
+    for (address, value) in transaction.inputs:
+        input_dict[address] = input_dict.get(address, 0) + value
 
     # consolodate output addresses
     output_dict = {}
-    for output in transaction.outputs:
-        if output[0] in output_dict:
-            output_dict[output[0]] += output[1]
-        else:
-            output_dict[output[0]] = output[1]
-    transaction.outputs = list(output_dict.items())
+    for (address, value) in transaction.outputs:
+        output_dict[address] = output_dict.get(address, 0) + value
 
     # consolodate addresses that appear in both the inputs and outputs
-    inputs_to_remove = []
-    outputs_to_remove = []
-    for (i, input) in enumerate(transaction.inputs):
-        for (j, output) in enumerate(transaction.outputs):
-
-            if input[0] == output[0]:
-
-                if input[1] == output[1]:
-                    inputs_to_remove.append(input)
-                    outputs_to_remove.append(output)
-
-                elif output[1] > input[1]:
-                    new_output = (output[0], output[1] - input[1])
+    # each address appears at most once on each side at this point, so shared
+    # addresses can be found with dictionary lookups instead of comparing every
+    # input against every output
+    shared_addresses = [
+        address for address in input_dict if address in output_dict]
+    for address in shared_addresses:
+        input_value = input_dict[address]
+        output_value = output_dict[address]
+
+        if input_value == output_value:
+            del input_dict[address]
+            del output_dict[address]
+
+        elif output_value > input_value:
+            output_dict[address] = output_value - input_value
+            del input_dict[address]
 
-                    inputs_to_remove.append(input)
-                    transaction.outputs[j] = new_output
-
-                else:
-                    new_input = (input[0], input[1] - output[1])
-
-                    transaction.inputs[i] = new_input
-                    outputs_to_remove.append(output)
+        else:
+            input_dict[address] = input_value - output_value
+            del output_dict[address]
 
-    transaction.inputs = [
-        input for input in transaction.inputs if input not in inputs_to_remove]
-    transaction.outputs = [
-        output for output in transaction.outputs if output not in outputs_to_remove]
+    transaction.inputs = list(input_dict.items())
+    transaction.outputs = list(output_dict.items())
 
     return transaction
 
 
-def sort_key(input):
-    return input[1]
+# inputs and outputs are sorted by value with itemgetter, which avoids calling
+# a python function for every element during the sort
+sort_key = itemgetter(1)
 
 
 def remove_small_inputs(transaction):
     transaction.inputs.sort(key=sort_key)
 
-    inputs_to_remove = []
+    # the inputs are sorted, so the inputs being removed are always a prefix
+    num_to_remove = 0
     for input in transaction.inputs:
         if input[1] <= transaction.fee:
-            inputs_to_remove.append(input)
+            num_to_remove += 1
             transaction.fee -= input[1]
         else:
             break
 
-    transaction.inputs = [
-        x for x in transaction.inputs if x not in inputs_to_remove]
+    transaction.inputs = transaction.inputs[num_to_remove:]
     return transaction
 
 # small output removal criteria from "Shared Send Untangling in Bitcoin"
 
 
-def remove_small_outputs(transaction):
-    acceptable_partitions = get_acceptable_partitions(transaction)
+def get_largest_min_flow(acceptable_partitions):
+    '''
+    input:      the acceptable partitions of a transaction
 
-    # find the largets minimum change in value from inputs to outputs over all
-    # subsets from all partitions
+    returns:    the largest minimum change in value from inputs to outputs over
+                all subsets from all partitions, or zero if there are none
+    '''
     delta = 0
     for partition in acceptable_partitions:
-        input_partition = partition[0]
-        output_partition = partition[1]
-        partition_size = len(input_partition)
-
-        input_subset = input_partition[0]
-        output_subset = output_partition[0]
+        input_sums = [sum(input[1] for input in subset)
+                      for subset in partition[0]]
+        output_sums = [sum(output[1] for output in subset)
+                       for subset in partition[1]]
 
         # find the smallest net change in value from inputs to outputs over all
         # subsets in the partition
-        min_flow = sum([input[1] for input in input_subset]) - \
-            sum([output[1] for output in output_subset])
-        for i in range(1, partition_size):
-            input_subset = input_partition[i]
-            output_subset = output_partition[i]
-
-            flow = sum([input[1] for input in input_subset]) - \
-                sum([output[1] for output in output_subset])
-            if flow < min_flow:
-                min_flow = flow
+        min_flow = min(
+            input_sum - output_sum for (input_sum, output_sum)
+            in zip(input_sums, output_sums))
 
         if min_flow > delta:
             delta = min_flow
 
+    return delta
+
+
+def remove_small_outputs(transaction):
+    num_inputs = len(transaction.inputs)
+    num_outputs = len(transaction.outputs)
+
+    # a transaction with fewer than two inputs or outputs has no acceptable
+    # partitions, so there is no need to enumerate them
+    if num_inputs < 2 or num_outputs < 2:
+        delta = 0
+
+    # a transaction with two inputs and two outputs can only be partitioned by
+    # pairing each input with one of the outputs, so both pairings are checked
+    # directly
+    elif num_inputs == 2 and num_outputs == 2:
+        (input_a, input_b) = [input[1] for input in transaction.inputs]
+        (output_a, output_b) = [output[1] for output in transaction.outputs]
+
+        delta = 0
+        for (out_a, out_b) in [(output_a, output_b), (output_b, output_a)]:
+            if (is_connectable(input_a, out_a, transaction.fee)
+                    and is_connectable(input_b, out_b, transaction.fee)):
+                min_flow = min(input_a - out_a, input_b - out_b)
+                if min_flow > delta:
+                    delta = min_flow
+
+    else:
+        acceptable_partitions = get_acceptable_partitions(transaction)
+        delta = get_largest_min_flow(acceptable_partitions)
+
     transaction.outputs.sort(key=sort_key)
 
-    outputs_to_remove = []
+    # the outputs are sorted, so the outputs being removed are always a prefix
+    num_to_remove = 0
     for output in transaction.outputs:
         if output[1] <= delta:
-            outputs_to_remove.append(output)
+            num_to_remove += 1
             transaction.fee += output[1]
         else:
             break
 
-    transaction.outputs = [
-        x for x in transaction.outputs if x not in outputs_to_remove]
+    transaction.outputs = transaction.outputs[num_to_remove:]
     return transaction
 
 
@@ -427,6 +621,17 @@ def classify_transaction(transaction):
 # --- misc ---
 
 
+def get_chunksize(num_items, num_processes):
+    '''
+    input:      the number of items being mapped over a process pool, and the
+                number of processes in the pool
+
+    returns:    a chunksize giving each process about four chunks, so items are
+                sent to the workers in batches instead of one at a time
+    '''
+    return max(1, num_items // (num_processes * 4))
+
+
 def profile_transactions(transactions):
     type_dict = {
         'total': 0,
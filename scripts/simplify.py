@@ -2,7 +2,7 @@ from time import perf_counter
 import multiprocessing as mp
 import os
 
-from functions import classify_transaction, get_file_names_regex, load_transactions_from_csv, simplify_transaction, profile_transactions
+from functions import classify_transaction, get_file_names_regex, load_transactions_from_csv, write_transactions_to_csv, simplify_transaction, profile_transactions, get_chunksize
 
 
 def simplify_transactions(data_io_directory, file_pattern):
@@ -37,18 +37,16 @@ def simplify_transactions(data_io_directory, file_pattern):
         print()
 
         print(f'{indent}    simplifying transactions... ', end='', flush=True)
-        simplified_transactions = pool.map(simplify_transaction, transactions)
+        chunksize = get_chunksize(len(transactions), num_processes)
+        simplified_transactions = pool.map(
+            simplify_transaction, transactions, chunksize=chunksize)
         print(f'done')
 
         # some simplified transactions will have zero inputs or zero outputs
         # theses transactions will not be included in the output
-        transactions_to_remove = []
-        for transaction in simplified_transactions:
-            if len(transaction.inputs) == 0 or len(transaction.outputs) == 0:
-                transactions_to_remove.append(transaction)
-
         simplified_transactions = [
-            tx for tx in simplified_transactions if tx not in transactions_to_remove]
+            tx for tx in simplified_transactions
+            if len(tx.inputs) != 0 and len(tx.outputs) != 0]
 
         # simplifying a transaction could potentially change it classification
         # so all simplifed transactions should be reclassified
@@ -56,9 +54,18 @@ def simplify_transactions(data_io_directory, file_pattern):
             f'{indent}    reclassifying simplifed transactions... ',
             end='',
             flush=True)
-        for index, tx in enumerate(simplified_transactions):
-            if tx.type == 'unclassified':
-                simplified_transactions[index] = classify_transaction(tx)
+        unclassified_indices = [
+            index for (index, tx) in enumerate(simplified_transactions)
+            if tx.type == 'unclassified']
+        unclassified_txs = [simplified_transactions[index]
+                            for index in unclassified_indices]
+
+        chunksize = get_chunksize(len(unclassified_txs), num_processes)
+        reclassified_txs = pool.map(
+            classify_transaction, unclassified_txs, chunksize=chunksize)
+
+        for (index, tx) in zip(unclassified_indices, reclassified_txs):
+            simplified_transactions[index] = tx
         print('done')
 
         tx_summary = profile_transactions(simplified_transactions)
@@ -67,13 +74,8 @@ def simplify_transactions(data_io_directory, file_pattern):
         print()
 
         print(f'{indent}    writing new csv file... ', end='', flush=True)
-        with open(f'{output_directory}/{file_name}', 'w') as output_file:
-
-            output_file.write(
-                'transaction_hash,num_inputs,input_addresses,input_values,num_outputs,output_addresses,output_values,transaction_fee,transaction_class\n')
-
-            for transaction in simplified_transactions:
-                output_file.write(transaction.to_csv_string())
+        write_transactions_to_csv(
+            f'{output_directory}/{file_name}', simplified_transactions)
         print('done')
 
         simp_end = perf_counter()
@@ -3,7 +3,7 @@ from itertools import permutations
 import multiprocessing as mp
 import os
 
-from functions import get_file_names_regex, load_transactions_from_csv, func, classify_transaction, profile_transactions
+from functions import get_file_names_regex, load_transactions_from_csv, write_transactions_to_csv, func, classify_transaction, profile_transactions, get_chunksize
 
 
 def untangle_transactions(data_io_directory, file_pattern):
@@ -40,7 +40,8 @@ def untangle_transactions(data_io_directory, file_pattern):
         print()
 
         print(f'{indent}    untangling transactions... ', end='', flush=True)
-        untangled_txs = pool.map(func, transactions)
+        chunksize = get_chunksize(len(transactions), num_processes)
+        untangled_txs = pool.map(func, transactions, chunksize=chunksize)
         # untangled_txs will contain sublists, so it needs to be flattened
         # before proceding
         untangled_txs = [item for sublist in untangled_txs for item in sublist]
@@ -52,9 +53,18 @@ def untangle_transactions(data_io_directory, file_pattern):
             f'{indent}    reclassifying untangled transactions... ',
             end='',
             flush=True)
-        for index, tx in enumerate(untangled_txs):
-            if tx.type == 'unclassified':
-                untangled_txs[index] = classify_transaction(tx)
+        unclassified_indices = [
+            index for (index, tx) in enumerate(untangled_txs)
+            if tx.type == 'unclassified']
+        unclassified_txs = [untangled_txs[index]
+                            for index in unclassified_indices]
+
+        chunksize = get_chunksize(len(unclassified_txs), num_processes)
+        reclassified_txs = pool.map(
+            classify_transaction, unclassified_txs, chunksize=chunksize)
+
+        for (index, tx) in zip(unclassified_indices, reclassified_txs):
+            untangled_txs[index] = tx
         print('done')
 
         tx_summary = profile_transactions(untangled_txs)
@@ -63,13 +73,8 @@ def untangle_transactions(data_io_directory, file_pattern):
         print()
 
         print(f'{indent}    writing new csv file... ', end='', flush=True)
-        with open(f'{output_directory}/{file_name}', 'w') as output_file:
-
-            output_file.write(
-                'transaction_hash,num_inputs,input_addresses,input_values,num_outputs,output_addresses,output_values,transaction_fee,transaction_class\n')
-
-            for transaction in untangled_txs:
-                output_file.write(transaction.to_csv_string())
+        write_transactions_to_csv(
+            f'{output_directory}/{file_name}', untangled_txs)
         print('done')
 
         untangle_end = perf_counter()